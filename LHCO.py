@@ -31,8 +31,8 @@ import shutil
 import psutil
 import requests
 import multiprocessing as mpi
-from time import sleep
-from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threading import Thread
 from pathlib import Path
 
 import h5py
@@ -41,7 +41,7 @@ import numpy as np
 import pandas as pd
 
 from jetminer import clustering_LHCO
-from jetminer.core.clustering import _save_images, _save_scalars
+from jetminer.core.clustering import load_masterkey
 
 mpi.set_start_method('fork')
 
@@ -113,58 +113,139 @@ def download_file(url, path, descriptor=None, chunk_size=1024**2, timeout=None):
         url (str): URL of the file
         path (Path): The location where the file will be saved
         descriptor (string): Progres bar annotation
-        chunksize  (int): Number of bytes per chunk
+        chunk_size (int): Number of bytes copied per read
         timeout (float or tuple): Seconds to wait for the response
 
+    The file is downloaded under a temporary name and only moved to `path`
+    once complete, so a failed transfer never leaves a truncated file there.
+
     Returns:
         None
     """
     ans = requests.get(url, stream=True, timeout=timeout)
-    with open(path, "wb") as file:
-        for chunk in tqdm.tqdm(ans.iter_content(chunk_size),
-                          unit='MB',
-                          desc=descriptor):
-            if chunk:
-                file.write(chunk)
+    ans.raise_for_status()
+    ans.raw.decode_content = True
+    total = int(ans.headers.get("content-length", 0))
+    partial = Path(f"{path}.part")
+    try:
+        with open(partial, "wb") as file:
+            with tqdm.tqdm.wrapattr(ans.raw, "read", total=total,
+                                    desc=descriptor) as raw:
+                shutil.copyfileobj(raw, file, length=chunk_size)
+        os.replace(partial, path)
+    finally:
+        if partial.exists():
+            partial.unlink()
 
 def merge(path, feature):
     """Merge all *.hdf* files in given directory.
 
-    This function is called once at the end of the clustering run in order to 
-    unite all the partial results obtained from parallell clustering 
-    execution.
+    Every partial file holds the ``bkg`` and, for labelled data, ``sig``
+    events of one chunk. This function unites all the partial results 
+    obtained from parallell clustering execution in memory; the clustering
+    run itself streams them to disk with ``merge_all``.
 
     Return:
-      ``pd.DataFrame`` from merged *.hdf* files
+      Background and signal ``pd.DataFrame`` (or ``np.ndarray`` for images)
+      from merged *.hdf* files, ``None`` where no events are available
     """
-    
-    signal_files = sorted(path.glob(f"{feature}_sig*"))
-    background_files = sorted(path.glob(f"{feature}_bkg*"))
+    files = sorted(path.glob(f"{feature}[0-9]*.h5"))
 
-    files_list = [background_files, signal_files]
     data_merged = []
-    for files in files_list:
-        if feature == "images":
-            array_list = []
-            if files:
-                for filename in files:
-                    hf = h5py.File(filename, 'r')
-                    key = list(hf.keys())[0]
-                    array_list.append(np.array(hf[key][:]))
-            data_merged.append(np.concatenate(array_list)
-                            if array_list else None)
+    for key in ["bkg", "sig"]:
+        parts = []
+        for filename in files:
+            with h5py.File(filename, 'r') as hf:
+                if key in hf:
+                    parts.append(hf[key][()])
+                    columns = hf[key].attrs.get("columns")
+        if not parts:
+            data_merged.append(None)
+        elif feature == "images":
+            data_merged.append(np.concatenate(parts))
         elif feature == "scalars":
-            df_list = []
-            if files:
-                for filename in files:
-                    df = pd.read_hdf(filename)
-                    df.reset_index(drop=True)
-                    df_list.append(df)
-            data_merged.append(pd.concat(df_list, axis=0, ignore_index=True)
-                            if df_list else None)
+            data_merged.append(pd.DataFrame(np.concatenate(parts), 
+                                            columns=list(columns)))
 
     return data_merged[0], data_merged[1]
 
+def _partial_sizes(files, key):
+    """Lists the files holding a `key` dataset and their number of rows."""
+    sizes = []
+    for filename in files:
+        with h5py.File(filename, 'r') as hf:
+            if key in hf:
+                sizes.append((filename, hf[key].shape[0]))
+    return sizes
+
+def merge_scalars(files, out_file, key):
+    """Appends partial scalar files to a single output table.
+
+    Partial results are streamed one at a time into an ``HDFStore`` table,
+    instead of being concatenated in memory before writing. The index is
+    renumbered so that it runs contiguously over the merged table. Nothing
+    is written if none of the files holds `key` events.
+
+    Args:
+        files (list): paths of the partial *.hdf* scalar files, in order
+        out_file (Path): path of the merged output file
+        key (str): name of the events' dataset and of the output table
+
+    Return:
+        None
+    """
+    sizes = _partial_sizes(files, key)
+    if not sizes:
+        return
+
+    offset = 0
+    with pd.HDFStore(out_file, mode="w") as store:
+        for filename, n_events in sizes:
+            with h5py.File(filename, 'r') as hf:
+                columns = list(hf[key].attrs["columns"])
+                # PyTables does not write empty tables, so skip them
+                if n_events:
+                    df = pd.DataFrame(hf[key][()], columns=columns,
+                                      index=pd.RangeIndex(offset,
+                                                          offset+n_events))
+                    store.append(key, df)
+                    offset += n_events
+        if not offset:
+            store.put(key, pd.DataFrame(columns=columns, dtype=float))
+
+def merge_images(files, out_file, key):
+    """Copies partial image files into a single preallocated dataset.
+
+    The output dataset is created once with the combined number of events
+    and every partial file is written into its own row range, so at most
+    one partial result is held in memory at a time. Nothing is written if
+    none of the files holds `key` events.
+
+    Args:
+        files (list): paths of the partial *.hdf* image files, in order
+        out_file (Path): path of the merged output file
+        key (str): name of the events' dataset, in both partial and output
+            files
+
+    Return:
+        None
+    """
+    sizes = _partial_sizes(files, key)
+    if not sizes:
+        return
+
+    with h5py.File(sizes[0][0], 'r') as hf:
+        shape, dtype = hf[key].shape[1:], hf[key].dtype
+    n_events = sum(n for _, n in sizes)
+
+    with h5py.File(out_file, 'w') as out:
+        dset = out.create_dataset(key, shape=(n_events, *shape), dtype=dtype)
+        offset = 0
+        for filename, n in sizes:
+            with h5py.File(filename, 'r') as hf:
+                dset[offset:offset+n] = hf[key][()]
+            offset += n
+
 def merge_all(tmp_dir, out_prefix, out_dir):
     """Merges both images and/or scalar files resulted from clustering.
     
@@ -178,72 +259,98 @@ def merge_all(tmp_dir, out_prefix, out_dir):
     Return:
         None
     """
-    for features in ["images", "scalars"]:
-        bkg_df, sig_df = merge(tmp_dir, features)
-        
-        if features == "scalars":
-            if bkg_df is not None:
-                bkg_df.to_hdf(
-                    out_dir.joinpath(f"{out_prefix}_{features}_bkg.h5"), 
-                    key="bkg")
-            if sig_df is not None:
-                sig_df.to_hdf(
-                    out_dir.joinpath(f"{out_prefix}_{features}_sig.h5"), 
-                    key="sig")
-        else:
-            if bkg_df is not None:
-                imgs_file = out_dir.joinpath(f"{out_prefix}_{features}_bkg.h5")
-                hf = h5py.File(imgs_file, 'w')
-                hf.create_dataset('bkg', data=bkg_df)
-                hf.close()
-            if sig_df is not None:
-                imgs_file = out_dir.joinpath(f"{out_prefix}_{features}_sig.h5")
-                hf = h5py.File(imgs_file, 'w')
-                hf.create_dataset('sig', data=sig_df)
-                hf.close()
-
-def run_procs(procs, n_workers, bar=None):
-    """Paralell execution of a collection of processes across `n_workers`.
-
-    Called by the `clusterin_mpi` function after setting up the jobs,
-    this function manages the execution of the parallel processes. Optionally
-    can display a progress bar for completed jobs.
+    for features, merge_fn in [("images", merge_images), 
+                               ("scalars", merge_scalars)]:
+        files = sorted(tmp_dir.glob(f"{features}[0-9]*.h5"))
+        for key in ["bkg", "sig"]:
+            merge_fn(files, 
+                     out_dir.joinpath(f"{out_prefix}_{features}_{key}.h5"),
+                     key)
+
+def available_cores():
+    """Returns the logical cores this process is allowed to run on.
+
+    Uses the scheduler affinity mask where the platform provides one, so
+    that ``taskset`` and cgroup CPU limits are respected. Otherwise falls
+    back to the number of physical cores.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(psutil.cpu_count(logical=False)))
+
+_cores = available_cores()
+"""list: logical cores available at import time"""
+
+_progress = None
+"""mpi.SimpleQueue: progress queue of the current pool worker"""
+
+def chunk_bounds(n_events, n_workers, chunk_size=0, min_size=100):
+    """Splits the events in chunks, given as a list of boundaries.
+
+    With a fixed ``chunk_size`` all chunks have the same size, except for 
+    the last one. Otherwise chunks are sized by guided scheduling: every 
+    chunk takes a ``1/(4*n_workers)`` share of the events still left, but 
+    no less than ``min_size``. Early chunks are large and the last ones are
+    small, so the workers finish close to each other instead of idling 
+    while a large final chunk completes.
+
+    Args:
+        n_events (int): Total number of events
+        n_workers (int): Number of parallel workers
+        chunk_size (int): Fixed number of events per chunk, 0 for guided
+            scheduling
+        min_size (int): Smallest chunk size used by guided scheduling
+
+    Returns:
+        List of chunk boundaries, from 0 to ``n_events``; chunk ``i`` spans
+        the events between elements ``i`` and ``i+1``.
+    """
+    if chunk_size:
+        return list(range(0, n_events, chunk_size)) + [n_events]
+    bounds = [0]
+    while bounds[-1] < n_events:
+        remaining = n_events - bounds[-1]
+        size = max(min_size, -(-remaining // (4*n_workers)))
+        bounds.append(min(n_events, bounds[-1] + size))
+    return bounds
+
+def _init_worker(core_queue, progress):
+    """Initializes a pool worker, optionally pinning it to a core of its own.
 
     Args:
-        procs (list): Collection of `mpi.Process` objects to be executed
-        n_workers (int): Number of physicals cores available for parallel 
-            execution of jobs
-        bar (obj): Instance of `tqdm.tqdm` used for displaying progress
+        core_queue (mpi.SimpleQueue): Queue of logical cores, each worker
+            takes one of them. Workers are not pinned if it is `None`
+        progress (mpi.SimpleQueue): Queue where the worker reports the 
+            number of processed events
+    """
+    global _progress
+    _progress = progress
+    if core_queue is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {core_queue.get()})
+
+def _cluster_chunk(*args, **kwargs):
+    """Runs `clustering_LHCO` reporting to the worker's progress queue."""
+    return clustering_LHCO(*args, progress=_progress, **kwargs)
+
+def _track_progress(progress, bar):
+    """Advances `bar` with the event counts posted to `progress`.
+
+    Runs until a ``None`` is received.
     """
-    process_queue = deque(procs)
-    finished = np.zeros(n_workers).astype(bool)
-    while sum(finished) < len(procs):
-        # Count the number of active cores
-        working = np.sum(list(map(lambda obj: obj.is_alive(), procs)))
-
-        # If all cores are busy wait, otherwise start new chunks
-        if working >= n_workers:
-            sleep(0.1)
-        else:
-            exited = np.array(
-                list(map(lambda obj: obj.exitcode, procs))) != None
-            done = np.sum(exited) - np.sum(finished)
-            if bar:
-                bar.update(done)
-            finished = exited
-            if len(process_queue) > 0:
-                process_queue.popleft().start()
+    for n in iter(progress.get, None):
+        bar.update(n)
 
 def clustering_mpi(path, j, max_events, chunk_size, tmp_dir, out_dir, 
                    out_prefix="results", quiet=False, scalars=True,
-                   images=False, **kwargs):
+                   images=False, pin_cores=False, **kwargs):
     """Applies clustering to LHC Olympics data using multiprocessing.
 
-    Main function performing the clustering. It spreads the input events
-    across ``j`` logical cores and prints a progress bar for each process'
-    progress towards completing a chunk of events. Each process stores its
-    result in a temporary fille; at the end of the clustering all filles
-    will be merged.
+    Main function performing the clustering. It splits the input events
+    in chunks which are distributed to a pool of ``j`` worker processes, 
+    and prints a progress bar of the processed events, which the workers 
+    report through a queue while clustering. Each chunk's result is stored
+    in a temporary fille; at the end of the clustering all filles will be 
+    merged.
 
     Args:
         path (Path): path of `.hdf` input file containing LHCO data.
@@ -252,8 +359,8 @@ def clustering_mpi(path, j, max_events, chunk_size, tmp_dir, out_dir,
         max_events (int): maximum number of events to be used. If 0, all events
             in the file will be used.
         chunk_size (int): number of events to be distributed to each job. If
-            0, then the chunk size will e adjusted so that the number of jobs 
-            is equal to the number of logical cores
+            0, chunks get smaller towards the end of the run (see 
+            ``chunk_bounds``)
         tmp_dir (Path): path of the directory where temporary result files
             will be stored. *All contents of the directory will be erased.* 
             If the directory does not exist, it will be created.
@@ -263,6 +370,9 @@ def clustering_mpi(path, j, max_events, chunk_size, tmp_dir, out_dir,
         quiet (bool): suppresses the output of ``tqdm`` progress bars
         scalars (bool): compute the scalar features after clustering
         images (bool): generate jet images after clustering
+        pin_cores (bool): pin every worker to a core of its own. Ignored 
+            when there are more workers than available cores, so that 
+            workers can move to idle cores.
         **kwargs: keyword arguments for specifing clustering parameters. 
             Default values can be found in the ``LHCO.params`` dict. 
     Return:
@@ -275,50 +385,72 @@ def clustering_mpi(path, j, max_events, chunk_size, tmp_dir, out_dir,
                             "no output features will be generated")
 
     # Get number of availabe cores and workers
-    n_max = psutil.cpu_count(logical=False)
+    cores = _cores
+    n_max = len(cores)
     n_workers = n_max if j == 0 else j
 
     # Get the number of events in the input file
-    f = h5py.File(path, "r")
-    n_events = f['df']["block0_values"].shape[0]
-    f.close()
+    with h5py.File(path, "r") as f:
+        n_events, n_columns = f['df']["block0_values"].shape
+    has_truth = n_columns % 3 == 1
     if max_events < n_events and max_events != 0:
         n_events = max_events
 
-    # Get the chunk size and list of chunks
-    if chunk_size == 0:
-        chunk_size = (n_events // n_workers) // 10 if n_events > 100*n_workers else 100
-    chunks = [i for i in range(0,n_events,chunk_size) ]
-    if n_events%chunk_size != 0:
-        chunks.append(n_events)
+    # Get the list of chunks
+    chunks = chunk_bounds(n_events, n_workers, chunk_size)
 
     # Define work directory tree
     if tmp_dir.exists():
         shutil.rmtree(tmp_dir)
     Path.mkdir(tmp_dir)
 
-    # Create progress bars for all parallel processes
-    pbars = [tqdm.tqdm(total=chunk_size, position=i+1, colour="cyan",
-                       leave=0, ncols=79, bar_format='{l_bar}{bar}',
-                       disable=quiet)
-             for i in range(n_workers)]
-
-    # Define all chunks as processes
-    procs = [mpi.Process(target=clustering_LHCO,
-                         args=(path, start,
-                               stop, tmp_dir),
-                         kwargs={**{"bars": pbars, "scalars": 
-                                    scalars, "images": images}, 
-                                **kwargs})
-             for start, stop
-             in zip(chunks[:-1], chunks[1:])]
-
-    # Define overall progress bar
-    main_bar = tqdm.tqdm(total=len(procs), desc="Finished chunks", ncols=79,
+    # Read the masterkey once, workers only get their own events' labels
+    truth_bit = None
+    if kwargs.get("masterkey"):
+        if has_truth:
+            raise ValueError("Masterkey given for data with truth bit")
+        truth_bit = load_masterkey(kwargs["masterkey"])
+
+    # One core per worker, only if asked and there are enough cores
+    core_queue = None
+    if pin_cores and n_workers <= n_max:
+        core_queue = mpi.SimpleQueue()
+        for core in cores[:n_workers]:
+            core_queue.put(core)
+
+    # Define overall progress bar, fed by the workers through a queue
+    progress = mpi.SimpleQueue()
+    main_bar = tqdm.tqdm(total=n_events, desc="Processed events", ncols=79,
                          position=0, bar_format='{l_bar}{bar}{elapsed}',
                          colour="green", disable=quiet)
-
-    run_procs(procs, n_workers, main_bar)
+    tracker = Thread(target=_track_progress, args=(progress, main_bar),
+                     daemon=True)
+    tracker.start()
+
+    # Define all chunks as jobs, processed by a pool of persistent workers
+    with ProcessPoolExecutor(max_workers=n_workers, 
+                             initializer=_init_worker,
+                             initargs=(core_queue, progress)) as executor:
+        jobs = [executor.submit(_cluster_chunk, path, start, stop, tmp_dir,
+                                scalars=scalars, images=images, chunk_id=i,
+                                truth_bit=truth_bit[start:stop]
+                                          if truth_bit is not None else None,
+                                has_truth=has_truth,
+                                **kwargs)
+                for i, (start, stop)
+                in enumerate(zip(chunks[:-1], chunks[1:]))]
+        try:
+            # Fail on the first broken chunk, whichever it is
+            for job in as_completed(jobs):
+                job.result()
+        except BaseException:
+            for job in jobs:
+                job.cancel()
+            raise
+        finally:
+            progress.put(None)
+            tracker.join()
+            main_bar.close()
 
     # In case of `None` prefix revert to default
     if out_prefix is None:
@@ -345,6 +477,9 @@ if __name__ == "__main__":
                      help="radius used for primary clustering")
     run.add_argument("-j", action="store", default=0, type=int,
                      help="number of parallel processes")
+    run.add_argument("--pin-cores", action="store_true",
+                     help="pin every process to a core of its own, when "
+                     "there are no more processes than available cores")
     run.add_argument("--max-events", action="store", default=0, type=int,
                      help="maximum number of events to cluster")
     run.add_argument("--chunk-size", action="store", default=0, type=int,
@@ -1,18 +1,17 @@
 import multiprocessing as mpi
 import json
 from operator import attrgetter
-from collections import ChainMap
+from functools import lru_cache
 from pathlib import Path
 
 import h5py
 import numpy as np
-import pandas as pd
 from pyjet import cluster, DTYPE_PTEPM, JetDefinition
 
 from jetminer import substructure
 from jetminer import eventlevel
 from jetminer.image import image_from_jets
-from jetminer.eventlevel.combinedmass import make_mass_fns
+from jetminer.eventlevel.combinedmass import mass_subsets, combined_masses
 
 
 FEATURES_PYJET = ["pt", "eta", "phi", "mass", "e", ]
@@ -23,94 +22,129 @@ FEATURES_EVENT = ["mjj", "nj"]
 """list: features calculated at the event level
 """
 
+_pyjet_getter = attrgetter(*FEATURES_PYJET)
+_p4_getter = attrgetter("e", "px", "py", "pz")
+_pyjet_zeros = (0,) * len(FEATURES_PYJET)
+_substructure_zeros = (0,) * len(substructure.__all__)
 
-def cluster_event(event, cluster_algo="antikt", R=1):
+# Feature functions, resolved once instead of per jet and per event
+_substructure_fns = tuple(getattr(substructure, feature)
+                          for feature in substructure.__all__)
+_eventlevel_fns = tuple(getattr(eventlevel, feature)
+                        for feature in eventlevel.__all__)
+
+PROGRESS_STEP = 100
+"""int: number of events between two progress reports of a worker
+"""
+
+IMAGE_CHUNK_BYTES = 1024 * 1024
+"""int: approximate size of the HDF5 chunks of the image partial results
+"""
+
+_pseudojets_buffer = np.zeros(0, dtype=DTYPE_PTEPM)
+"""np.ndarray: clustering input reused across events, grown when needed"""
+
+def cluster_event(event, cluster_algo="antikt", R=1, jet_def=None):
     """Clusters particle flow event data into jets.
 
     Args:
-        events (np.array): 1-dimensional array of particle information 
-            (pT, eta, phi).
+        events (np.array): array of particle information (pT, eta, phi),
+            either flat or already shaped as ``(n_particles, 3)``.
         cluster_algo (str): Selection of clustering algorithm. Possible 
             options are `kt`, `antikt`, `cambridge`, `genkt`.
         R (float): Jet radius used for clustering.
+        jet_def (`JetDefinition`): Pre-built jet definition, overrides
+            `cluster_algo` and `R` when given.
 
     Returns:
         Sequence of clustered jets.
     """
-    pseudojets_input = np.zeros(
-        np.count_nonzero(event)//3, dtype=DTYPE_PTEPM)
-    tmp = event[event.nonzero()].reshape(-1, 3)
-    pseudojets_input["pT"] = tmp[:, 0]
-    pseudojets_input["eta"] = tmp[:, 1]
-    pseudojets_input["phi"] = tmp[:, 2]
-    jdef = JetDefinition(cluster_algo, R)
-    return cluster(pseudojets_input, jdef)
+    global _pseudojets_buffer
+    # Particles are (pT, eta, phi) triplets, padded with zeros
+    tmp = event.reshape(-1, 3)
+    mask = tmp[:, 0] > 0
+    n = np.count_nonzero(mask)
+    if len(_pseudojets_buffer) < n:
+        _pseudojets_buffer = np.zeros(n, dtype=DTYPE_PTEPM)
+    pseudojets_input = _pseudojets_buffer[:n]
+    pseudojets_input["pT"] = tmp[mask, 0]
+    pseudojets_input["eta"] = tmp[mask, 1]
+    pseudojets_input["phi"] = tmp[mask, 2]
+    if jet_def is None:
+        jet_def = JetDefinition(cluster_algo, R)
+    return cluster(pseudojets_input, jet_def)
+
+
+@lru_cache()
+def feature_names(njets):
+    """Lists the names of all scalar features, in the order they are stored.
+
+    Event-level features come first, followed by the substructure and then
+    the pyjet features of every jet, with the jets in reversed pT ordering.
+    The names are only built once for every number of jets.
+
+    Args:
+        njets (int): Number of jets expected per event.
+
+    Returns:
+        Tuple of feature names, with jet index included in per-jet names.
+    """
+    names = list(eventlevel.__all__)
+    names += [name for name, _ in mass_subsets(njets)]
+    for idx in reversed(range(njets)):
+        names += [f"{feature}_{idx+1}" for feature in substructure.__all__]
+    for idx in reversed(range(njets)):
+        names += [f"{feature}_{idx+1}" for feature in FEATURES_PYJET]
+    return tuple(names)
 
 
-def pyjet_features(jet, idx):
-    """Creates feature dictionary with pyjet attributes.
+def pyjet_features(jet):
+    """Collects the pyjet attributes of a jet.
 
     Args:
         jet (`PseudoJet`): input jet
-        idx (int): input jet's index number (in pT ordering)
 
     Returns:
-        Dictionary of pyjet features, with jet index included in key names.
+        Tuple of pyjet features, ordered as in ``FEATURES_PYJET``.
     """
     if jet is not None:
-        return {
-            f"{feature}_{idx+1}": attrgetter(feature)(jet)
-            for feature in FEATURES_PYJET
-        }
+        return _pyjet_getter(jet)
     else:
-        return {
-            f"{feature}_{idx+1}": 0
-            for feature in FEATURES_PYJET
-        }
+        return _pyjet_zeros
 
 
-def substructure_features(jet, idx, **kwargs):
-    """Creates feature dictionary with jet's substructure variables.
+def substructure_features(jet, **kwargs):
+    """Computes the jet's substructure variables.
 
     Args:
         jet (`PseudoJet`): Input jet.
-        idx (int): Input jet's index number (in pT ordering).
         **kwargs: Arguments used in substructure variable calculation.
 
     Returns:
-        Dictionary of jet's substructure variables, with jet index included 
-        in key names.
+        Sequence of jet's substructure variables, ordered as in 
+        ``substructure.__all__``.
     """
     if jet is not None:
-        return {
-            f"{feature}_{idx+1}": getattr(substructure, feature)(jet, **kwargs)
-            for feature in substructure.__all__
-        }
+        # Reclustered sequences and N-subjettiness values shared by features
+        cache = {}
+        return [fn(jet, cache=cache, **kwargs) for fn in _substructure_fns]
     else:
-        return {
-            f"{feature}_{idx+1}": 0
-            for feature in substructure.__all__
-        }
+        return _substructure_zeros
 
 
 def event_features(jets):
-    """Creates feature dictionary event-level features.
+    """Computes the event-level features of a single event.
+
+    The combined masses are not included, they are computed for a whole 
+    chunk of events at once by ``combined_masses``.
 
     Args:
         jets (list of `PseudoJet`): Event clustered as a list of jets.
 
     Returns:
-        Dictionary of event-level features.
+        List of event-level features, ordered as in ``eventlevel.__all__``.
     """
-    masses = {
-        f"{fn.__name__}": fn(jets)
-        for fn in make_mass_fns(len(jets))
-    }
-    misc = {
-        f"{feature}": getattr(eventlevel, feature)(jets)
-        for feature in eventlevel.__all__
-    }
-    return {**misc, **masses}
+    return [fn(jets) for fn in _eventlevel_fns]
 
 
 def pad_list(l, size):
@@ -121,15 +155,16 @@ def pad_list(l, size):
         size (int): size of the padded list
 
     Returns:
-        The original list padded with `None` up to the given size
+        The list padded with `None` up to the given size, the input list is
+        returned unchanged if it is already long enough
     """
-    while len(l) < size:
-        l.append(None)
-    return l
+    return l + [None] * (size - len(l)) if len(l) < size else l
 
 
 def clustering_LHCO(path_in, start, stop, path_out, scalars=True,
-                    images=False, img_config=None, bars=None, **kwargs):
+                    images=False, img_config=None, progress=None, 
+                    chunk_id=None, truth_bit=None, has_truth=None, 
+                    **kwargs):
     """Runs a clustering algorithm on LHC Olympics data.
 
     Args:
@@ -141,86 +176,143 @@ def clustering_LHCO(path_in, start, stop, path_out, scalars=True,
         scalars (bool): compute the scalar features after clustering
         images (bool): generate jet images after clustering
         img_config (Path): json configuration file for image generation
-        bars (tqdm.std.tqdm): Progress bar objects defined with ``tqdm``
+        progress (mpi.SimpleQueue): Queue receiving the number of processed
+            events, posted every ``PROGRESS_STEP`` events
+        chunk_id (int): Index of the chunk, used for naming the result 
+            files. Defaults to the worker's process number.
+        truth_bit (np.ndarray): Masterkey labels of the chunk's events,
+            already read by the caller. If not given while a masterkey is 
+            used, the masterkey file is read here.
+        has_truth (bool): Whether the input rows end with a truth bit
+            column. Inferred from the number of columns when not given.
         **kwargs: jet clustering parameters
 
     Returns:
         Return code 0 for success. None otherwise
     """
-    pno = mpi.current_process()._identity[0]
-    if bars:
-        bar = bars[(pno-1) % len(bars)]
-    data = pd.read_hdf(path_in, start=start, stop=stop).to_numpy()
+    pno = mpi.current_process()._identity[0] if chunk_id is None else chunk_id
+    data = _read_events(path_in, start, stop)
+
+    if has_truth is None:
+        has_truth = data.shape[1] % 3 == 1
 
     if kwargs["masterkey"]:
-        if data.shape[1] % 3 == 1:
+        if has_truth:
             raise ValueError("Masterkey given for data with truth bit")
-        else:
-            truth_bit = np.fromfile(kwargs["masterkey"], dtype=float, 
-                                    sep='\n').astype(int)[start:stop]
+        elif truth_bit is None:
+            truth_bit = load_masterkey(kwargs["masterkey"])[start:stop]
 
-    elif data.shape[1] % 3 == 1:
+    elif has_truth:
         data, truth_bit = data[:, :-1], data[:, -1]
     else:
         truth_bit = None
 
+    # View the rows as (particle, [pT, eta, phi]) once for the whole chunk
+    data = data.reshape(len(data), -1, 3)
+
     if images:
         img_def = load_json(img_config)
+        # Precision of the saved images, computed in double precision
+        img_dtype = np.dtype(img_def.pop("dtype", "float64"))
+        # Plain casts would truncate normalized pixels to zero
+        if not np.issubdtype(img_dtype, np.floating):
+            raise ValueError(f"Image dtype must be floating, got {img_dtype}")
+
+    # Build the jet definition once per chunk, not once per event
+    jet_def = JetDefinition(kwargs["cluster_algo"], kwargs["R"])
+
+    # Scalar features are written straight into a preallocated array
+    if scalars:
+        columns = feature_names(kwargs["njets"])
+        datachunk = np.empty((len(data), len(columns)))
+        subsets = mass_subsets(kwargs["njets"])
+        n_misc = len(_eventlevel_fns)
+        n_event = n_misc + len(subsets)
+        # Jets' four-momenta, used for computing all combined masses at once
+        p4 = np.zeros((len(data), kwargs["njets"], 4))
 
-    datachunk = []
     imagechunk = []
-    for row in data:
-        seq = cluster_event(row, kwargs["cluster_algo"], kwargs["R"])
+    for i, row in enumerate(data, 1):
+        seq = cluster_event(row, jet_def=jet_def)
         jets = pad_list(seq.inclusive_jets(ptmin=kwargs["ptmin"])[
                             :kwargs["njets"]], kwargs["njets"])
         if scalars:
-            features = [pyjet_features(jet, i) for i, jet in enumerate(jets)]
-            features += [substructure_features(jet, i, **kwargs)
-                        for i, jet in enumerate(jets)]
-            features += [event_features(np.array(jets))]
-            feature_dict = dict(ChainMap(*features))
-            datachunk.append(feature_dict)
+            datachunk[i-1, :n_misc] = event_features(jets)
+            features = []
+            for jet in reversed(jets):
+                features += substructure_features(jet, **kwargs)
+            for jet in reversed(jets):
+                features += pyjet_features(jet)
+            datachunk[i-1, n_event:] = features
+            for j, jet in enumerate(jets):
+                if jet is not None:
+                    p4[i-1, j] = _p4_getter(jet)
         if images:
             imagechunk.append(image_from_jets(jets, **img_def))
-        bar.desc = f"Chunk {pno:02d}"
-        bar.update(1)
+        if progress is not None and i % PROGRESS_STEP == 0:
+            progress.put(PROGRESS_STEP)
+    if progress is not None and len(data) % PROGRESS_STEP:
+        progress.put(len(data) % PROGRESS_STEP)
 
     if scalars:
-        _save_scalars(pd.DataFrame(datachunk), truth_bit, pno, path_out)
+        datachunk[:, n_misc:n_event] = combined_masses(p4, subsets)
+        _save_scalars(datachunk, columns, truth_bit, pno, path_out)
     if images:
-        _save_images(np.stack(imagechunk), truth_bit, pno, path_out)
+        _save_images(np.stack(imagechunk).astype(img_dtype, copy=False), 
+                     truth_bit, pno, path_out)
 
     return 0
 
-def _save_scalars(datachunk, truth_bit, pno, path_out):
-    folder_out = Path(path_out)
-    if truth_bit is not None:
-        mask_sig = truth_bit == 1
-        datachunk[~mask_sig].to_hdf(
-            folder_out.joinpath(f"scalars_bkg{pno:02d}.h5"),
-            key="bkg")
-        datachunk[mask_sig].to_hdf(
-            folder_out.joinpath(f"scalars_sig{pno:02d}.h5"),
-            key="sig")
-    else:
-        datachunk.to_hdf(folder_out.joinpath(f"scalars_bkg{pno:02d}.h5"),
-                    key="bkg")
+def _read_events(path_in, start, stop):
+    """Reads rows `start` to `stop` of the LHCO events table.
 
-def _save_images(imagechunk, truth_bit, pno, path_out):
-    folder_out = Path(path_out)
-    if truth_bit is not None:
-        mask_sig = truth_bit == 1
-        imgs_file_sig = folder_out.joinpath(f"images_sig{pno:02d}.h5")
-        hf = h5py.File(imgs_file_sig, 'w')
-        hf.create_dataset('sig', data=imagechunk[mask_sig])
-        hf.close()
-    imgs_file_bkg = folder_out.joinpath(f"images_bkg{pno:02d}.h5")
-    hf = h5py.File(imgs_file_bkg, 'w')
-    hf.create_dataset('bkg', data=imagechunk[~mask_sig] 
-                                if mask_sig is not None 
-                                else imagechunk)
-    hf.close()
+    The values are read straight from the ``block0_values`` dataset of the
+    pandas ``fixed`` format file in a single contiguous hyperslab, skipping
+    the pandas/PyTables reconstruction of the DataFrame. The input file is
+    only kept open while the chunk is read.
 
+    Values are converted to ``float32`` while reading, which is well within
+    the detector resolution and halves the memory of the chunk; they are
+    only cast back to double precision per event, for clustering.
+    """
+    with h5py.File(path_in, "r") as hf:
+        dset = hf["df"]["block0_values"]
+        data = np.empty((stop-start, dset.shape[1]), dtype=np.float32)
+        dset.read_direct(data, np.s_[start:stop])
+    return data
+
+def _split_labels(chunk, truth_bit):
+    """Splits a chunk in background and signal events, keyed by label."""
+    if truth_bit is None:
+        return {"bkg": chunk}
+    mask_sig = truth_bit == 1
+    return {"bkg": chunk[~mask_sig], "sig": chunk[mask_sig]}
+
+def _save_scalars(datachunk, columns, truth_bit, pno, path_out):
+    filename = Path(path_out).joinpath(f"scalars{pno:05d}.h5")
+    with h5py.File(filename, "w", libver="latest") as hf:
+        for key, part in _split_labels(datachunk, truth_bit).items():
+            dset = hf.create_dataset(key, data=part, compression="lzf",
+                                     shuffle=True)
+            dset.attrs["columns"] = np.array(columns, 
+                                             dtype=h5py.string_dtype())
+
+def _save_images(imagechunk, truth_bit, pno, path_out):
+    filename = Path(path_out).joinpath(f"images{pno:05d}.h5")
+    with h5py.File(filename, "w", libver="latest") as hf:
+        for key, part in _split_labels(imagechunk, truth_bit).items():
+            if len(part) == 0:
+                hf.create_dataset(key, data=part)
+                continue
+            # Chunks of whole images, about 1 MB each
+            nevt = max(1, IMAGE_CHUNK_BYTES // part[0].nbytes)
+            hf.create_dataset(key, data=part, compression="lzf", shuffle=True,
+                              chunks=(min(len(part), nevt), *part.shape[1:]))
+
+
+def load_masterkey(filename):
+    """Reads the truth labels of all events from a masterkey file."""
+    return np.fromfile(filename, dtype=float, sep='\n').astype(np.int8)
 
 def load_json(filename):
     with open(filename, 'r') as f:
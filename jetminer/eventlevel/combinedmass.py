@@ -1,11 +1,7 @@
 from itertools import chain, combinations
-from functools import reduce
-from this import d
 
 import numpy as np
 
-from .helpers import combined_mass
-
 
 def powerset(iterable):
     """Returns all subset combinantions containing at least two elements.
@@ -24,48 +20,48 @@ def powerset(iterable):
     return chain.from_iterable(combinations(s, r) for r in range(2, len(s)+1))
 
 
-def make_mass_fns(njets):
-    """Creates functions calculating the combined mass of `jets` subsets.
-
-    A separate function will be created for each subset of `jets` containing
-    at least two elements. The function will be named accordingly.
+def mass_subsets(njets):
+    """Lists the subsets of jets whose combined mass is computed.
 
     Args:
-        njets (list of `PseudoJet`): The number of jets expected within
-            clustered every event
-    
+        njets (int): The number of jets expected within every clustered 
+            event
+
     Returns:
-        List of functions for calculation all possible combinened masses.
+        List of ``(name, indices)`` pairs, one for every subset containing 
+        at least two jets. Names are built from the jet indices, e.g. 
+        ``mj1j2`` for the two leading jets.
     """
-    idx = np.arange(njets)
-    combs = powerset(idx)
-    
-    return [mass_clojure(idx) for idx in combs]
+    return [("m" + "".join(f"j{i+1:d}" for i in idx), 
+             np.asarray(idx, dtype=np.intp))
+            for idx in powerset(range(njets))]
+
+
+def combined_masses(p4, subsets):
+    """Calculates the combined masses of jet subsets for a batch of events.
 
-def mass_clojure(idx):
-    """Makes a function to calculate the combined masss, using given indices
-    
-    This clojure creates a function that computes the combined mass of a 
-    subset of jets within an event. It works under the assumption that all 
-    clustered events have the same number of jets.
+    The four-momenta of every subset are summed for all events at once, 
+    instead of looping over events and jets in Python.
 
     Args:
-        idx (list of 'int'): The indices of the jets taken into account when
-            computing the combined masss.
+        p4 (np.ndarray): Jets' four-momenta ``(E, px, py, pz)`` with shape
+            ``(n_events, njets, 4)``; missing jets are filled with zeros.
+        subsets (list): ``(name, indices)`` pairs given by ``mass_subsets``
 
     Returns:
-        the funtion created
+        Array of shape ``(n_events, len(subsets))`` with the combined 
+        invariant masses, in GeV.
     """
-    def f(jets):
-        return combined_mass(jets[np.array(idx)])
-
-    # generate a unique name based on the indices
-    name = [f"j{i+1:d}" for i in idx]
-    name.insert(0, "m")
-    f.__name__ = reduce(str.__add__, name)
-
-    return f
-
-# def mjj(jets):
-#     return combined_mass(jets)
-
+    masses = np.empty((p4.shape[0], len(subsets)))
+    total = np.empty((p4.shape[0], 4))
+    for k, (_, idx) in enumerate(subsets):
+        # Squared mass is computed in place, in the output column
+        m2 = masses[:, k]
+        np.sum(p4[:, idx, :], axis=1, out=total)
+        np.square(total, out=total)
+        np.subtract(total[:, 0], total[:, 1], out=m2)
+        np.subtract(m2, total[:, 2], out=m2)
+        np.subtract(m2, total[:, 3], out=m2)
+        np.maximum(m2, 0, out=m2)
+        np.sqrt(m2, out=m2)
+    return masses
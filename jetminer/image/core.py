@@ -9,6 +9,9 @@ rap_i = 1
 phi_i = 2
 """column index of the azymuthal angle ``phi``"""
 
+DEFAULT_NPIX = 32
+"""int: default number of pixels on one edge of the jet images"""
+
 default_options = {
 
         'fcut': 0.05,   
@@ -41,13 +44,18 @@ def average_centroid(jet, npix, pix_width):
     """
     rap_avg = np.average(jet[:,rap_i], weights=jet[:,pT_i])
     phi_avg = np.average(jet[:,phi_i], weights=jet[:,pT_i])
-    rap_pt_cent_index = np.ceil(rap_avg/pix_width - 0.5) - np.floor(npix / 2)
-    phi_pt_cent_index = np.ceil(phi_avg/pix_width - 0.5) - np.floor(npix / 2)
-    rap_indices = np.ceil(jet[:,rap_i]/pix_width - 0.5) - rap_pt_cent_index
-    phi_indices = np.ceil(jet[:,phi_i]/pix_width - 0.5) - phi_pt_cent_index
+    half = np.floor(npix / 2)
+    rap_indices = _pixel_index(jet[:,rap_i], pix_width)
+    rap_indices -= _pixel_index(rap_avg, pix_width) - half
+    phi_indices = _pixel_index(jet[:,phi_i], pix_width)
+    phi_indices -= _pixel_index(phi_avg, pix_width) - half
 
     return rap_indices, phi_indices
 
+def _pixel_index(x, pix_width):
+    """Converts coordinates in the rapidity-azimuth plane to pixel indices"""
+    return np.ceil(x/pix_width - 0.5)
+
 def trim_jet(pseudojets_input, subjet_array, R, fcut):
     """Applies jet trimming based on arguments.
 
@@ -63,20 +71,14 @@ def trim_jet(pseudojets_input, subjet_array, R, fcut):
     Returns:
         constituents array of the jet, after trimming
     """
-    trimmed_jet = []
-    for subjet in subjet_array:
-        # get main cluster pt
-        main_cluster = cluster(pseudojets_input, R=R, p=-1)
-        parent_pt = main_cluster.inclusive_jets()[0].pt
-
-        if subjet.pt > parent_pt * fcut:
-            # Get the subjets pt, eta, phi constituents
-            subjet_data = subjet.constituents_array()
-            subjet_data = subjet_data.view((float, 
-                            len(subjet_data.dtype.names))
-                        )
-            trimmed_jet.append(subjet_data)
-    return np.concatenate(trimmed_jet)[:,:3]
+    # get main cluster pt, the same for all subjets
+    main_cluster = cluster(pseudojets_input, R=R, p=-1)
+    parent_pt = main_cluster.inclusive_jets()[0].pt
+
+    # get the pt, eta, phi constituents of the subjets passing trimming
+    trimmed_jet = [_jet_to_array(subjet) for subjet in subjet_array
+                   if subjet.pt > parent_pt * fcut]
+    return np.concatenate(trimmed_jet)
 
 def make_image(jet, rap_indices, phi_indices, npix):
     """Creates a jet image using indices in ``y`` and ``phi``.
@@ -92,21 +94,17 @@ def make_image(jet, rap_indices, phi_indices, npix):
     """
 
     # delete elements outside of range
-    mask = np.ones(jet[:,rap_i].shape).astype(bool)
-    mask[rap_indices < 0] = False
-    mask[phi_indices < 0] = False
-    mask[rap_indices >= npix] = False
-    mask[phi_indices >= npix] = False
+    mask = ((rap_indices >= 0) & (rap_indices < npix) 
+            & (phi_indices >= 0) & (phi_indices < npix))
     rap_indices = rap_indices[mask].astype(int)
     phi_indices = phi_indices[mask].astype(int)
-    
-    jet_image = np.zeros((npix, npix, 1))
 
-    # construct grayscale image
-    for pt,y,phi in zip(jet[:,pT_i][mask], rap_indices, phi_indices): 
-        jet_image[phi, y, 0] += pt
+    # construct grayscale image, accumulating the pt of every pixel at once
+    jet_image = np.bincount(phi_indices * npix + rap_indices, 
+                            weights=jet[:,pT_i][mask], 
+                            minlength=npix * npix)
     
-    return jet_image
+    return jet_image.reshape(npix, npix, 1)
 
 def pseudojet(jet):
     """Returns a numpy array of dtype ``DTYPE_PTEPM``
@@ -153,47 +151,38 @@ def transform(jet, subjet_array, img_width, pix_width, rotate, offset):
     else:
         rap_e = subjet_array[1].eta
         phi_e = subjet_array[1].phi
-    new_origin = np.array([0, rap_p, phi_p])
     
     # translate jet to put pivot in origin (0, 0)
-    jet = jet-new_origin
-
+    rap = jet[:,rap_i] - rap_p
+    phi = jet[:,phi_i] - phi_p
 
     if rotate:
         # compute the unit vector of the edge
         r = np.array([rap_p-rap_e, phi_p-phi_e])
         ur = r/np.linalg.norm(r)
 
-        # define vertical axis unit vector 
-        uy = np.array([0, 1])
-
-        # rotation angle for bringing edge on the certical axis
-        theta = np.arccos(np.dot(uy, ur))*(np.sign(ur[0]))
-        
-        # anticlockwise rotation matrix
-        rotate2d = np.array([[np.cos(theta), np.sin(theta)],
-                            [-np.sin(theta), np.cos(theta)]])
+        # rotation angle for bringing edge on the vertical axis
+        theta = np.arccos(ur[1])*(np.sign(ur[0]))
+        cos_t, sin_t = np.cos(theta), np.sin(theta)
 
-        # apply rotation to all jet constituents' coordinates
-        jet[:,1:] = np.dot(jet[:,1:],rotate2d)
+        # anticlockwise rotation of all jet constituents' coordinates
+        rap, phi = rap*cos_t - phi*sin_t, rap*sin_t + phi*cos_t
 
-    # translate to place pivot according to offset
-    jet =  jet+np.array([0, img_width/2, img_width*offset])
-
-    # transistion to indices 
-    rap_indices = np.ceil(jet[:,rap_i]/pix_width - 0.5) 
-    phi_indices = np.ceil(jet[:,phi_i]/pix_width - 0.5)
+    # translate to place pivot according to offset and get the indices
+    rap_indices = _pixel_index(rap + img_width/2, pix_width)
+    phi_indices = _pixel_index(phi + img_width*offset, pix_width)
 
     return rap_indices, phi_indices
 
 
 def pixelate(jet, 
-             npix=32, 
+             npix=DEFAULT_NPIX, 
              img_width=0.8, 
              trim=False,
              norm=False, 
              avg_centroid=False,
              rotate=True,
+             pseudojets_input=None,
              **kwargs):
     """A function for creating a jet image from an array of particles.
     
@@ -209,6 +198,8 @@ def pixelate(jet,
         rotate (bool) :rotate image to align leading secondary clusters on the 
             vertical
         norm (bool) whether or not to normalize the $p_T$ pixels to sum to `1`
+        pseudojets_input (np.ndarray): the same particles as a ``pyjet`` 
+            compatible array, built from `jet` when not given
     
     Return:
         `np.ndarray` jet image of shape `(npix, npix, 1)`
@@ -222,7 +213,8 @@ def pixelate(jet,
     pix_width = img_width / npix
 
     # pseudojet inputs necessary for `pyjet` clustering
-    pseudojets_input = pseudojet(jet)
+    if pseudojets_input is None:
+        pseudojets_input = pseudojet(jet)
 
     # remove particles with zero pt
     jet = jet[jet[:,pT_i] > 0]
@@ -276,22 +268,25 @@ def image_from_jets(jets, stitch_jets=False, **kwargs):
         3-D array
     """
     if stitch_jets:
-        arr = np.concatenate([_jet_to_array(x) for x in jets if x is not None])
-        img = np.asarray(pixelate(arr, **kwargs))
+        constit = np.concatenate([x.constituents_array() 
+                                  for x in jets if x is not None])
+        img = np.asarray(pixelate(_constituents_view(constit), 
+                                  pseudojets_input=constit, **kwargs))
     else:
-        arr = [pixelate(_jet_to_array(x), **kwargs) 
-                        for x in jets 
-                        if x is not None]
-        arr = np.squeeze(np.asarray(arr),-1)
-        img = np.moveaxis(arr, 0, -1)
-        njets = len(jets)
-        missing_jets = njets - img.shape[2]
-        npix = img.shape[0]
-        if missing_jets>0:
-            padding = np.zeros(shape=(npix,npix,missing_jets))
-            img = np.concatenate([img, padding], axis=2)
+        # every jet is pixelated straight into its own channel, missing
+        # jets are left as empty channels at the end
+        npix = kwargs.get("npix", DEFAULT_NPIX)
+        img = np.zeros((npix, npix, len(jets)))
+        present = (x for x in jets if x is not None)
+        for i, x in enumerate(present):
+            constit = x.constituents_array()
+            img[:, :, i] = pixelate(_constituents_view(constit), 
+                                    pseudojets_input=constit, **kwargs)[..., 0]
     return img
 
 def _jet_to_array(jet):
-    constit = jet.constituents_array()
+    return _constituents_view(jet.constituents_array())
+
+def _constituents_view(constit):
+    # (pT, eta, phi) columns of a constituents array, without copying
     return constit.view((float, len(constit.dtype.names)))[:,:3]
\ No newline at end of file
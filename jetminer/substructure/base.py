@@ -1,32 +1,52 @@
-from functools import lru_cache
-
 import numpy as np
 from pyjet import cluster
 
-from .helpers import subjettiness
+from .helpers import constituents, subjettiness
+
+
+def kt_sequence(jet, R, cache=None):
+    """Reclusters the jet's constituents with the kt algorithm.
+
+    Args:
+        jet (`PseudoJet`): Input jet.
+        R (float): Jet radius used for reclustering.
+        cache (dict): Results already computed for this jet. The sequence 
+            is only clustered once for every radius and then reused.
 
-cluster_lru = lru_cache(maxsize=16)(cluster)
+    Returns:
+        The kt `ClusterSequence` of the jet's constituents.
+    """
+    if cache is None:
+        return cluster(jet, R=R, algo='kt')
+    key = ("kt", R)
+    if key not in cache:
+        cache[key] = cluster(jet, R=R, algo='kt')
+    return cache[key]
 
 
-def nisj(jet, **kwargs):
-    seq = cluster_lru(jet, R=kwargs["R2"], algo='kt')
+def nisj(jet, cache=None, **kwargs):
+    seq = kt_sequence(jet, kwargs["R2"], cache)
     return len(seq.inclusive_jets(ptmin=kwargs["ptmin2"]))
 
 
-def nesj(jet, **kwargs):
-    seq = cluster_lru(jet, R=kwargs["R2"], algo='kt')
+def nesj(jet, cache=None, **kwargs):
+    seq = kt_sequence(jet, kwargs["R2"], cache)
     return seq.n_exclusive_jets(kwargs["dcut"])
 
 
-@lru_cache(maxsize=8)
-def tau(jet, i, **kwargs):
-    cnsts = jet.constituents()
-    if len(cnsts) >= i:
-        seq = cluster_lru(jet, R=kwargs["R"], algo='kt')
+def tau(jet, i, cache=None, **kwargs):
+    key = ("tau", i)
+    if cache is not None and key in cache:
+        return cache[key]
+    if len(jet) >= i:
+        seq = kt_sequence(jet, kwargs["R"], cache)
         cndts = seq.exclusive_jets(i)
-        return subjettiness(cndts, cnsts)
+        result = subjettiness(cndts, constituents(jet, cache)[0])
     else:
-        return 0
+        result = 0
+    if cache is not None:
+        cache[key] = result
+    return result
 
 def nc(jet, **kwargs):
     return len(jet)
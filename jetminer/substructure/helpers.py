@@ -1,27 +1,71 @@
-from functools import lru_cache
-
 import numpy as np
 
 
-@lru_cache()
-def delta_r(jet1, jet2):
-    return ((jet1.phi-jet2.phi)**2 + (jet1.eta-jet2.eta)**2)**0.5
+def constituents(jet, cache=None):
+    """Returns the jet's constituents arrays, in both coordinate systems.
+
+    Args:
+        jet (`PseudoJet`): Input jet.
+        cache (dict): Results already computed for this jet. The arrays are
+            only materialized once and then shared by all features.
+
+    Returns:
+        The ``(pT, eta, phi, mass)`` and ``(E, px, py, pz)`` constituents 
+        arrays of the jet.
+    """
+    if cache is not None and "constituents" in cache:
+        return cache["constituents"]
+    arrays = jet.constituents_array(), jet.constituents_array(ep=True)
+    if cache is not None:
+        cache["constituents"] = arrays
+    return arrays
 
 
 def subjettiness(candidates, constituents):
-    d0 = sum(c.pt for c in constituents)
-    ls = []
-    for c in constituents:
-        dRs = [delta_r(c, cd) for cd in candidates]
-        ls += [c.pt * min(dRs)]
-    return np.sum(ls)/d0
-
-
-def energy_ring(jet, dR_min, dR_max):
-    cnsts = jet.constituents()
-    energy = 0
-    for c in cnsts:
-        dr = delta_r(jet, c)
-        if dr >= dR_min and dr <= dR_max:
-            energy += c.e
-    return energy/jet.e
+    """Computes the N-subjettiness of a jet.
+
+    Distances between all constituents and all candidate subjets are 
+    computed at once, as a ``(n_constituents, n_candidates)`` matrix.
+
+    Args:
+        candidates (list of `PseudoJet`): Candidate subjet axes.
+        constituents (np.ndarray): Jet's constituents array, with the 
+            ``pT``, ``eta`` and ``phi`` fields.
+
+    Returns:
+        The pT-weighted sum of distances to the closest candidate, 
+        normalized by the jet's scalar pT sum.
+    """
+    n = len(candidates)
+    eta_cd = np.fromiter((cd.eta for cd in candidates), float, n)
+    phi_cd = np.fromiter((cd.phi for cd in candidates), float, n)
+    dR2 = ((constituents["phi"][:, None] - phi_cd)**2
+           + (constituents["eta"][:, None] - eta_cd)**2)
+    pt = constituents["pT"]
+    return np.sum(pt * np.sqrt(dR2.min(axis=1))) / np.sum(pt)
+
+
+def energy_ring(jet, dR_min, dR_max, cache=None):
+    """Computes the fraction of the jet's energy in a ring around its axis.
+
+    Args:
+        jet (`PseudoJet`): Input jet.
+        dR_min (float): Inner radius of the ring.
+        dR_max (float): Outer radius of the ring.
+        cache (dict): Results already computed for this jet, where the
+            constituents' distances to the jet axis are shared by all rings.
+
+    Returns:
+        Energy of the constituents with ``dR_min <= dR <= dR_max``, 
+        divided by the jet's energy.
+    """
+    if cache is not None and "ring_dr" in cache:
+        dr, energy = cache["ring_dr"]
+    else:
+        cnsts, cnsts_ep = constituents(jet, cache)
+        dr = np.sqrt((jet.phi - cnsts["phi"])**2 
+                     + (jet.eta - cnsts["eta"])**2)
+        energy = cnsts_ep["E"]
+        if cache is not None:
+            cache["ring_dr"] = dr, energy
+    return np.sum(energy[(dr >= dR_min) & (dr <= dR_max)]) / jet.e
@@ -1,9 +1,4 @@
-import types
-
-import numpy as np
-
 from .helpers import energy_ring
-rings = __import__(__name__)
 
 DEFAULT_RINGS = [[0, 0.01], [0.01, 0.01668101], [0.01668101, 0.02782559],
                  [0.02782559, 0.04641589], [0.04641589, 0.07742637],
@@ -13,12 +8,13 @@ DEFAULT_RINGS = [[0, 0.01], [0.01, 0.01668101], [0.01668101, 0.02782559],
 
 
 def make_ring_fn(ring, no):
-    def f(jet, **kwargs):
-        return energy_ring(jet, *ring)
-    globals()[f"eRing{no:d}"] = f
-    #exec(f"global eRing{no:d}; eRing{no:d} = f")
+    """Builds the feature function of the `no`-th energy ring."""
+    def f(jet, cache=None, **kwargs):
+        return energy_ring(jet, *ring, cache=cache)
+    f.__name__ = f.__qualname__ = f"eRing{no:d}"
+    return f
 
 
-if __name__ != "__main__":
-    for no, ring in enumerate(DEFAULT_RINGS):
-        make_ring_fn(ring, no)
+(eRing0, eRing1, eRing2, eRing3, eRing4,
+ eRing5, eRing6, eRing7, eRing8, eRing9) = (
+    make_ring_fn(ring, no) for no, ring in enumerate(DEFAULT_RINGS))
@@ -2,7 +2,12 @@ import unittest
 
 import os
 import requests
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from threading import Thread
 
 import h5py
 import pandas as pd
@@ -15,168 +20,252 @@ DATA_URL =  "https://github.com/lhcolympics2020/parsingscripts/raw/a4"\
         "64a08fa288d275a97148b5a063cae9aa19cfa7/events_anomalydetection_"\
         "tiny.h5"
 
+
+CI_MAX_EVENTS = int(os.environ.get("CI_MAX_EVENTS", "0"))
+"""int: events clustered in the ``mpi`` run, all of them if 0"""
+
+TMP_DIR = Path("./tmp_dir/")
+OUT_DIR = Path("./test_results/")
+
+CONFIGS = {
+    "single_core": {
+        "j": 1,
+        "chunk_size": 150,
+        "max_events": 500,
+    },
+    "mpi": {
+        "j": 10,
+        "chunk_size": 0,
+        "max_events": CI_MAX_EVENTS,
+        "njets": 4,
+        "R": 0.3,
+    },
+    "imgs": {
+        "j": 10,
+        "chunk_size": 0,
+        "max_events": 0,
+        "scalars": False,
+        "images": True,
+        "img_config": "./img_config.json",
+        "njets": 2,
+        "R": 1,
+    },
+}
+"""dict: clustering runs tested, on top of the default ``params``"""
+
+_runs = {}
+
+
+def run_configs():
+    """Runs every configuration in `CONFIGS` once, in its own directories.
+
+    Returns:
+        Dict of the arguments used for every run, by configuration name.
+    """
+    if not _runs:
+        TMP_DIR.mkdir(exist_ok=True)
+        for name, config in CONFIGS.items():
+            args = dict(params, path=DATA_PATH, quiet=True,
+                        tmp_dir=TMP_DIR.joinpath(name),
+                        out_dir=OUT_DIR.joinpath(name))
+            args.update(config)
+            args["out_dir"].mkdir(parents=True, exist_ok=True)
+            _runs[name] = args
+
+        # The runs are independent and are started together when possible,
+        # each from its own single-threaded process, since forking its pool
+        # of workers from a thread could copy locks held by other threads
+        if (os.cpu_count() or 1) >= len(_runs):
+            with ProcessPoolExecutor(max_workers=len(_runs)) as executor:
+                jobs = [executor.submit(clustering_mpi, **args)
+                        for args in _runs.values()]
+                for job in jobs:
+                    job.result()
+        else:
+            for args in _runs.values():
+                clustering_mpi(**args)
+    return _runs
+
+
+@lru_cache(maxsize=8)
+def _read_file(reader, path, mtime):
+    return reader(path)
+
+
+def read_cached(reader, path):
+    """Reads a result file with `reader`, only once while it is unchanged"""
+    return _read_file(reader, str(path), os.path.getmtime(path))
+
+
+def read_images(path):
+    with h5py.File(path, 'r') as hf:
+        dset = hf[next(iter(hf))]
+        images = np.empty(dset.shape, dtype=dset.dtype)
+        dset.read_direct(images)
+        return images
+
+
+def read_columns(path):
+    """Returns the column names of a scalar results table, without its rows"""
+    with pd.HDFStore(path, mode="r") as store:
+        storer = store.get_storer(store.keys()[0])
+        return frozenset(storer.non_index_axes[0][1])
+
+
+def count_rows(path):
+    """Returns the number of rows of a scalar results table"""
+    with h5py.File(path, 'r') as hf:
+        key = next(iter(hf))
+        return hf[key]["table"].shape[0]
+
+
+def setUpModule():
+    # Download the test dataset once, and reuse it if it is already there
+    if not DATA_PATH.is_file() or DATA_PATH.stat().st_size == 0:
+        download_file(DATA_URL, DATA_PATH)
+
+@unittest.skipIf(os.environ.get("OFFLINE"), "OFFLINE is set")
 class TestDownload(unittest.TestCase):
 
     def test_links(self):
-        try:
-            requests.get(DATA_URL, stream=True, timeout=5)
-        except ConnectionError:
-            self.fail("Test dataset url could not be reached")
+        r = requests.head(DATA_URL, allow_redirects=True, timeout=5)
+        self.assertEqual(r.status_code, 200)
 
     def test_download(self):
-        try:
-            download_file(DATA_URL, DATA_PATH)
-        except Exception:
-            self.fail('Exception raised during dataset download')
-
+        # The dataset is fetched by `setUpModule` unless already present
         self.assertTrue(Path(DATA_PATH).exists())
+        self.assertTrue(h5py.is_hdf5(DATA_PATH))
+        with h5py.File(DATA_PATH, 'r') as hf:
+            self.assertEqual(hf["df"]["block0_values"].shape, (1000, 2101))
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
 
-class TestClustering(unittest.TestCase):
+
+class TestDownloadFile(unittest.TestCase):
+    """Runs `download_file` against a local server, without network access"""
 
     @classmethod
     def setUpClass(cls):
-        download_file(DATA_URL, DATA_PATH)
-        cls.tmp = Path("./tmp_dir/")
-        cls.out_dir = Path(".")
-        cls.out_bkg = Path("./results_scalars_bkg.h5")
-        cls.out_sig = Path("./results_scalars_sig.h5")
-        cls.img_bkg = Path("./results_images_bkg.h5")
-        cls.img_sig = Path("./results_images_sig.h5")
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.root = Path(cls.tmp.name)
+        cls.served = cls.root.joinpath("served")
+        cls.served.mkdir()
+        # A few MiB, so the file is copied in more than one read
+        cls.content = np.random.default_rng(0).bytes(3 * 1024**2 + 17)
+        cls.served.joinpath("data.bin").write_bytes(cls.content)
+
+        handler = partial(_QuietHandler, directory=str(cls.served))
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
 
-    def test_single_core(self):
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.tmp.cleanup()
 
-        default_args = {
-            "j": 1,
-            "path": DATA_PATH,
-            "chunk_size": 150,
-            "max_events": 500,
-            "tmp_dir": self.tmp,
-            "out_dir": self.out_dir,
-            "quiet": True
-        }
-        default_args.update(params)
+    def test_download(self):
+        path = self.root.joinpath("data.bin")
+        download_file(f"{self.url}/data.bin", path, chunk_size=1024**2)
 
-        try:
-            clustering_mpi(**default_args)
-        except Exception:
-            self.fail("Exceptions raised during clustering")
+        self.assertEqual(path.read_bytes(), self.content)
+        self.assertFalse(Path(f"{path}.part").exists())
 
-        self.assertTrue(self.tmp.is_dir())
-        self.assertTrue(os.listdir(self.tmp))
-        self.assertTrue(self.out_bkg.is_file())
-        self.assertTrue(self.out_sig.is_file())
+    def test_http_error(self):
+        path = self.root.joinpath("missing.bin")
+        with self.assertRaises(requests.HTTPError):
+            download_file(f"{self.url}/missing.bin", path)
 
+        self.assertFalse(path.exists())
+        self.assertFalse(Path(f"{path}.part").exists())
 
-    def test_mpi(self):
 
-        mpi_args = {
-            "j": 10,
-            "path": DATA_PATH,
-            "chunk_size": 0,
-            "max_events": 0,
-            "tmp_dir": self.tmp,
-            "quiet": True,
-            "out_dir": self.out_dir
-        }
-        mpi_args.update(params)
-        mpi_args['njets'] = 4
-        mpi_args['R'] = 0.3
-        try:
-            clustering_mpi(**mpi_args)
-        except Exception:
-            self.fail("Exceptions raised during clustering")
-
-        self.assertTrue(self.tmp.is_dir())
-        self.assertTrue(os.listdir(self.tmp))
-        self.assertTrue(self.out_bkg.is_file())
-        self.assertTrue(self.out_sig.is_file())
+class TestClustering(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.runs = run_configs()
+
+    def test_single_core(self):
+        self._check_outputs("single_core", "scalars")
+
+    def test_mpi(self):
+        self._check_outputs("mpi", "scalars")
 
     def test_imgs(self):
+        self._check_outputs("imgs", "images")
 
-        mpi_args = {
-            "j": 10,
-            "path": DATA_PATH,
-            "chunk_size": 0,
-            "max_events": 0,
-            "scalars": False,
-            "images": True,
-            "img_config": "./img_config.json",
-            "tmp_dir": self.tmp,
-            "quiet": True,
-            "out_dir": self.out_dir
-        }
-        mpi_args.update(params)
-        mpi_args['njets'] = 2
-        mpi_args['R'] = 1
-        try:
-            clustering_mpi(**mpi_args)
-        except Exception:
-            self.fail("Exceptions raised during clustering")
-
-        self.assertTrue(self.tmp.is_dir())
-        self.assertTrue(os.listdir(self.tmp))
-        self.assertTrue(self.img_bkg.is_file())
-        self.assertTrue(self.img_sig.is_file())
+    def _check_outputs(self, name, kind):
+        args = self.runs[name]
+        self.assertTrue(args["tmp_dir"].is_dir())
+        self.assertTrue(os.listdir(args["tmp_dir"]))
+        outputs = {f"results_{kind}_{label}.h5" for label in ("bkg", "sig")}
+        with os.scandir(args["out_dir"]) as entries:
+            present = {entry.name for entry in entries if entry.is_file()}
+        self.assertTrue(outputs <= present)
 
 
 class TestScalars(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.result_files = [Path("results_scalars_bkg.h5"), 
-                       Path("results_scalars_sig.h5")]
+        out_dir = run_configs()["single_core"]["out_dir"]
+        cls.result_files = [out_dir.joinpath("results_scalars_bkg.h5"), 
+                            out_dir.joinpath("results_scalars_sig.h5")]
+        with open('./tests/columns.txt', "r") as f:
+            cls.true_col = frozenset(f.read().split(","))
 
 
     def test_file_integrity(self):
         for f in self.result_files:
-            try:
-                pd.read_hdf(f)
-            except Exception:
-                self.fail("scalar results could not be read")
+            read_cached(pd.read_hdf, f)
 
     def test_data_format(self):
-        sig_col = set(pd.read_hdf(self.result_files[1]).columns)
-        bkg_col = set(pd.read_hdf(self.result_files[0]).columns)
+        sig_col = read_cached(read_columns, self.result_files[1])
+        bkg_col = read_cached(read_columns, self.result_files[0])
 
-        with open('./tests/columns.txt', "r") as f:
-            col = f.read()
-        true_col = set(col.split(","))
-
-        self.assertTrue(sig_col == bkg_col == true_col)
+        self.assertTrue(sig_col == bkg_col == self.true_col)
 
     def test_data_size(self):
-        sig = pd.read_hdf(self.result_files[1])
-        bkg = pd.read_hdf(self.result_files[0])
+        # Only the number of rows is needed, read from the table's shape
+        n_sig = count_rows(self.result_files[1])
+        n_bkg = count_rows(self.result_files[0])
 
-        self.assertEqual(sig.shape[0], 44)
-        self.assertEqual(bkg.shape[0], 456)
+        self.assertEqual(n_sig, 44)
+        self.assertEqual(n_bkg, 456)
 
 class TestImages(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.result_files = [Path("results_images_bkg.h5"), 
-                       Path("results_images_sig.h5")]
-
+        out_dir = run_configs()["imgs"]["out_dir"]
+        cls.result_files = [out_dir.joinpath("results_images_bkg.h5"), 
+                            out_dir.joinpath("results_images_sig.h5")]
+        # Expected split of all events, from the input's truth bit column
+        with h5py.File(DATA_PATH, 'r') as hf:
+            truth_bit = hf["df"]["block0_values"][:, -1]
+        cls.n_sig = int(np.count_nonzero(truth_bit == 1))
+        cls.n_bkg = len(truth_bit) - cls.n_sig
 
     def test_file_integrity(self):
         for f in self.result_files:
-            try:
-               self._read_img(f)
-            except Exception:
-                self.fail("Images could not be read")
+            read_cached(read_images, f)
 
     def test_data_format(self):
-        self.sig = self._read_img(self.result_files[1])
-        self.bkg = self._read_img(self.result_files[0])
+        self.sig = read_cached(read_images, self.result_files[1])
+        self.bkg = read_cached(read_images, self.result_files[0])
 
-        self.assertTrue(self.sig.shape == (82, 32, 32, 2))
-        self.assertTrue(self.bkg.shape == (818, 32, 32, 2))
+        # All 1000 events are clustered
+        self.assertEqual(self.n_sig + self.n_bkg, 1000)
+        self.assertEqual(self.sig.shape[0], self.n_sig)
+        self.assertEqual(self.bkg.shape[0], self.n_bkg)
+        self.assertTrue(self.sig.shape[1:] == (32, 32, 2))
+        self.assertTrue(self.bkg.shape[1:] == (32, 32, 2))
 
-    def _read_img(self, path):
-        hf = h5py.File(path, 'r')
-        key = list(hf.keys())[0]
-        return np.array(hf[key][:])
 
 
 